@@ -1,13 +1,25 @@
 import os
 import json
 import hashlib
+import hmac
+import concurrent.futures
+from collections import OrderedDict
 import datetime
-import re
+import io
+import mmap
+import pickle
+import random
+import stat
+import tempfile
+import threading
+import time
+from zoneinfo import ZoneInfo
 import streamlit as st
-import google.generativeai as genai
-import pandas as pd
-import matplotlib.pyplot as plt
-import pytz
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 # =================================================
@@ -23,66 +35,243 @@ DATA_DIR = "data"
 USERS_FILE = f"{DATA_DIR}/users.json"
 HISTORY_FILE = f"{DATA_DIR}/history.json"
 DIET_FILE = f"{DATA_DIR}/diet_plans.json"
-os.makedirs(DATA_DIR, exist_ok=True)
+DIETS_DIR = f"{DATA_DIR}/diets"
+HISTORY_DIR = f"{DATA_DIR}/history"
+LLM_CACHE_DIR = f"{DATA_DIR}/llm_cache"
+for d in [DATA_DIR, DIETS_DIR, HISTORY_DIR, LLM_CACHE_DIR]:
+    os.makedirs(d, exist_ok=True)
+
+@st.cache_resource
+def _ist():
+    return ZoneInfo("Asia/Kolkata")
 
-IST = pytz.timezone("Asia/Kolkata")
-now_ist = datetime.datetime.now(IST)
+@st.cache_data(ttl=60, show_spinner=False)
+def today_info():
+    now_ist = datetime.datetime.now(_ist())
+    return now_ist.date().isoformat(), now_ist.strftime("%A")
 
-TODAY_DATE = now_ist.date().isoformat()
-TODAY_NAME = now_ist.strftime("%A")
+TODAY_DATE, TODAY_NAME = today_info()
 
 
 # =================================================
 # HELPERS
 # =================================================
+def json_loads(data):
+    return orjson.loads(data) if orjson else json.loads(data)
+
+def json_dumps(data):
+    if orjson:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    return json.dumps(data, indent=2).encode()
+
+@st.cache_data(show_spinner=False)
+def _load_json_cached(path, mtime):
+    # mtime is part of the cache key so edits on disk invalidate the entry
+    if not os.path.getsize(path):
+        return None
+    # Parse straight from the mapped file instead of reading it into a copy
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        # orjson reads the mapping directly; stdlib json needs bytes
+        with memoryview(mm) as view:
+            try:
+                return json_loads(view if orjson else mm[:])
+            except ValueError:
+                # Whitespace-only files count as empty
+                if not mm[:].strip():
+                    return None
+                raise
+
 def load_json(path, default):
     if not os.path.exists(path):
         return default
-    with open(path, "r") as f:
-        return json.load(f)
+    data = _load_json_cached(path, os.stat(path).st_mtime_ns)
+    return default if data is None else data
+
+def _atomic_write(path, payload):
+    # Write to a temp file in the same directory, then swap it in so
+    # readers never see a partially written file
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        try:
+            f = os.fdopen(fd, "wb", buffering=1024 * 1024)
+        except BaseException:
+            os.close(fd)
+            raise
+        with f:
+            f.write(payload)
+        # mkstemp creates 0600 files; keep the target's mode. A missing
+        # target is created empty first so the kernel applies the umask
+        # (readers treat an empty file as the default)
+        if not os.path.exists(path):
+            os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o666))
+        os.chmod(tmp, stat.S_IMODE(os.stat(path).st_mode))
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
 
 def save_json(path, data):
-    with open(path, "w") as f:
-        json.dump(data, f, indent=2)
+    _atomic_write(path, json_dumps(data))
+    _load_json_cached.clear()
 
-def hash_password(pwd):
-    return hashlib.sha256(pwd.encode()).hexdigest()
+@st.cache_data(show_spinner=False)
+def _load_pickle_cached(path, mtime):
+    # mtime is part of the cache key so edits on disk invalidate the entry
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+def load_pickle(path, default):
+    if not os.path.exists(path):
+        return default
+    return _load_pickle_cached(path, os.stat(path).st_mtime_ns)
+
+def save_pickle(path, obj):
+    _atomic_write(path, pickle.dumps(obj, protocol=5))
+    _load_pickle_cached.clear()
+
+def _user_path(base, email):
+    return f"{base}/{hashlib.sha256(email.encode()).hexdigest()}.pkl"
+
+def load_user_data(base, legacy_path, email, default):
+    # One pickle per user; fall back to the old shared file so existing
+    # data keeps loading until it is next saved
+    path = _user_path(base, email)
+    if os.path.exists(path):
+        return load_pickle(path, default)
+    return load_json(legacy_path, {}).get(email, default)
+
+def save_user_data(base, email, data):
+    save_pickle(_user_path(base, email), data)
+
+def index_by_day(hist):
+    # Weekday name -> most recent date saved for it
+    by_day = {}
+    for date, v in hist.items():
+        if date > by_day.get(v["day"], ""):
+            by_day[v["day"]] = date
+    return by_day
+
+@st.cache_data(show_spinner=False)
+def _history_index_cached(email, path, mtime):
+    # path/mtime of the file the history came from invalidate the entry
+    return index_by_day(load_user_data(HISTORY_DIR, HISTORY_FILE, email, {}))
+
+def history_index(email):
+    path = _user_path(HISTORY_DIR, email)
+    if not os.path.exists(path):
+        path = HISTORY_FILE
+    mtime = os.stat(path).st_mtime_ns if os.path.exists(path) else None
+    return _history_index_cached(email, path, mtime)
+
+PBKDF2_ITERATIONS = 200_000
+LOGIN_CACHE_SIZE = 1024
+
+def hash_password(pwd, salt=None):
+    salt = salt or os.urandom(16).hex()
+    digest = hashlib.pbkdf2_hmac(
+        "sha256", pwd.encode(), bytes.fromhex(salt), PBKDF2_ITERATIONS
+    ).hex()
+    return {"salt": salt, "hash": digest}
+
+@st.cache_resource
+def _executor():
+    return concurrent.futures.ThreadPoolExecutor(max_workers=2)
+
+@st.cache_resource
+def _login_cache():
+    # (email, stored hash, sha256(password)) -> bool, shared across sessions
+    return OrderedDict(), threading.Lock()
+
+def verify_password(email, pwd, record):
+    if isinstance(record, str):
+        # Legacy unsalted sha256 entry
+        return hmac.compare_digest(record, hashlib.sha256(pwd.encode()).hexdigest())
+
+    # LRU shared by all sessions' script threads, so guard it with the lock;
+    # the PBKDF2 itself runs outside the lock
+    cache, lock = _login_cache()
+    key = (email, record["hash"], hashlib.sha256(pwd.encode()).hexdigest())
+    with lock:
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+
+    ok = hmac.compare_digest(
+        record["hash"], hash_password(pwd, record["salt"])["hash"]
+    )
+    with lock:
+        cache[key] = ok
+        cache.move_to_end(key)
+        while len(cache) > LOGIN_CACHE_SIZE:
+            cache.popitem(last=False)
+    return ok
 
 # =================================================
 # AUTH
 # =================================================
+def prehash_password():
+    # Start hashing as soon as the signup password changes
+    pwd = st.session_state.get("signup_pwd") or ""
+    st.session_state["_pw_fut"] = (
+        hashlib.sha256(pwd.encode()).hexdigest(),
+        _executor().submit(hash_password, pwd)
+    )
+
+def _password_future(pwd):
+    pending = st.session_state.get("_pw_fut")
+    if pending and pending[0] == hashlib.sha256(pwd.encode()).hexdigest():
+        return pending[1]
+    return _executor().submit(hash_password, pwd)
+
 def signup(email, password):
+    # Hash in the background while the users file is checked
+    hashed = _password_future(password)
     users = load_json(USERS_FILE, {})
     if email in users:
         return False
-    users[email] = hash_password(password)
+    users[email] = hashed.result()
     save_json(USERS_FILE, users)
+    st.session_state.pop("_pw_fut", None)
     return True
 
 def login(email, password):
     users = load_json(USERS_FILE, {})
-    return email in users and users[email] == hash_password(password)
+    if email not in users or not verify_password(email, password, users[email]):
+        return False
+    if isinstance(users[email], str):
+        # Upgrade legacy sha256 entries on successful login
+        users[email] = hash_password(password)
+        save_json(USERS_FILE, users)
+    return True
 
 # =================================================
 # GEMINI
 # =================================================
-def get_client():
-    api_key = os.getenv("GOOGLE_API_KEY") or st.secrets.get("GOOGLE_API_KEY")
-    if not api_key:
-        st.error("GOOGLE_API_KEY not set")
-        st.stop()
-    genai.configure(api_key=api_key)
-    return genai
+GENERATION_CONFIG = {"response_mime_type": "application/json", "temperature": 0.2}
+MAX_ATTEMPTS = 3
 
-def build_prompt(user):
-    return f"""
+DIET_RULES = """
 STRICT RULES:
 - Return ONLY valid JSON
 - NO wrapper keys
 - Top-level keys must be weekdays (Monday–Sunday)
 - Each day must be a list
 - Each meal must have: dish, standard_quantity, calories (number)
+"""
 
+@st.cache_resource
+def get_model():
+    api_key = os.getenv("GOOGLE_API_KEY") or st.secrets.get("GOOGLE_API_KEY")
+    if not api_key:
+        st.error("GOOGLE_API_KEY not set")
+        st.stop()
+    import google.generativeai as genai
+    genai.configure(api_key=api_key)
+    # Shared rules live in the system instruction; prompts carry only the user block
+    return genai.GenerativeModel("gemini-2.5-flash", system_instruction=DIET_RULES)
+
+def build_prompt(user):
+    return f"""
 User:
 Goal: {user['goal']}
 Age: {user['age']}
@@ -95,20 +284,62 @@ Activity: {user['activity']}
 
 def extract_json(text):
     text = text.replace("```json", "").replace("```", "")
-    match = re.search(r"\{[\s\S]*\}", text)
-    if not match:
+    start, end = text.find("{"), text.rfind("}")
+    if start < 0 or end < start:
         return None
     try:
-        return json.loads(match.group())
+        return json_loads(text[start:end + 1])
     except:
         return None
 
+def read_json_stream(stream):
+    # Collect streamed text until the outermost JSON object closes
+    buf = []
+    depth = 0
+    started = in_str = escaped = False
+    for chunk in stream:
+        text = chunk.text
+        for i, ch in enumerate(text):
+            if in_str:
+                if escaped:
+                    escaped = False
+                elif ch == "\\":
+                    escaped = True
+                elif ch == '"':
+                    in_str = False
+            elif ch == '"':
+                in_str = started
+            elif ch == "{":
+                depth += 1
+                started = True
+            elif ch == "}" and started:
+                depth -= 1
+                if depth == 0:
+                    buf.append(text[:i + 1])
+                    return "".join(buf)
+        buf.append(text)
+    return "".join(buf)
+
 VALID_DAYS = [
     "Monday","Tuesday","Wednesday",
     "Thursday","Friday","Saturday","Sunday"
 ]
 
+def _coalesce(df, cols):
+    # First non-empty value across alias columns, row-wise
+    frame = df.reindex(columns=cols)
+    frame = frame.where(frame.notna() & frame.ne(""))
+    result = frame[cols[0]]
+    for c in cols[1:]:
+        result = result.combine_first(frame[c])
+    return result
+
 def normalize_diet_plan(raw):
+    import numpy as np
+    import pandas as pd
+
+    if not isinstance(raw, dict):
+        raise ValueError("AI diet is not a JSON object")
     if len(raw) == 1 and isinstance(list(raw.values())[0], dict):
         raw = list(raw.values())[0]
 
@@ -118,42 +349,137 @@ def normalize_diet_plan(raw):
         if not isinstance(meals, list):
             continue
 
-        clean = []
-        for m in meals:
-            dish = m.get("dish") or m.get("meal") or m.get("item")
-            qty = m.get("standard_quantity") or m.get("quantity") or "1 serving"
-            cal = m.get("calories") or m.get("kcal") or m.get("cal")
-            try:
-                cal = int(str(cal).replace("kcal", "").strip())
-            except:
-                continue
+        df = pd.DataFrame([m for m in meals if isinstance(m, dict)])
+        if df.empty:
+            continue
 
-            if dish and cal > 0:
-                clean.append({
-                    "dish": dish,
-                    "standard_quantity": qty,
-                    "calories": cal
-                })
+        cal = _coalesce(df, ["calories", "kcal", "cal"])
+        df = pd.DataFrame({
+            "dish": _coalesce(df, ["dish", "meal", "item"]),
+            "standard_quantity": _coalesce(df, ["standard_quantity", "quantity"]).fillna("1 serving"),
+            "calories": pd.to_numeric(
+                cal.astype(str).str.replace("kcal", "", regex=False).str.strip(),
+                errors="coerce"
+            )
+        })
+        df = df[df["dish"].notna() & np.isfinite(df["calories"]) & (df["calories"] > 0)]
 
-        if clean:
-            final[d] = clean
+        if not df.empty:
+            df["calories"] = df["calories"].astype(int)
+            final[d] = {
+                "meals": df.to_dict("records"),
+                "planned": int(df["calories"].sum())
+            }
 
     if not final:
-        st.error("AI diet invalid. Try again.")
-        st.stop()
+        raise ValueError("AI diet has no valid meals")
 
     return final
 
-def generate_diet(user):
-    client = get_client()
-    for _ in range(2):
-        res = client.GenerativeModel("gemini-2.5-flash").generate_content(build_prompt(user))
-        raw = extract_json(res.text)
-        if raw:
-            return normalize_diet_plan(raw)
-    st.error("Diet generation failed.")
+def with_planned(diet):
+    # Older diets store a bare meal list per day
+    return {
+        d: v if isinstance(v, dict) else {
+            "meals": v,
+            "planned": sum(m["calories"] for m in v)
+        }
+        for d, v in diet.items()
+    }
+
+DIET_CACHE_TTL = 24 * 3600
+
+def _diet_cache_path(profile_json):
+    return f"{LLM_CACHE_DIR}/{hashlib.sha256(profile_json.encode()).hexdigest()}.json"
+
+@st.cache_data(ttl=DIET_CACHE_TTL, show_spinner=False)
+def _generate_diet_cached(profile_json):
+    # Disk layer keeps generated diets across restarts, with the same TTL
+    cache_path = _diet_cache_path(profile_json)
+    if os.path.exists(cache_path) and time.time() - os.path.getmtime(cache_path) < DIET_CACHE_TTL:
+        cached = load_json(cache_path, None)
+        if cached:
+            return with_planned(cached)
+
+    from google.api_core import exceptions as api_exceptions
+
+    # Parse/validation failures and transient API errors are retried;
+    # anything else (bad key, SDK or programming errors) propagates
+    retriable = (
+        ValueError,
+        api_exceptions.ResourceExhausted,
+        api_exceptions.ServiceUnavailable,
+        api_exceptions.DeadlineExceeded,
+        api_exceptions.InternalServerError
+    )
+    user = json.loads(profile_json)
+    last_error = None
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            stream = get_model().generate_content(
+                build_prompt(user), generation_config=GENERATION_CONFIG, stream=True
+            )
+            text = read_json_stream(stream)
+            try:
+                raw = json_loads(text)
+            except ValueError:
+                raw = extract_json(text)
+            diet = normalize_diet_plan(raw)
+        except retriable as e:
+            last_error = e
+            if attempt < MAX_ATTEMPTS - 1:
+                time.sleep((2 ** attempt) * 0.25 + random.random() * 0.1)
+            continue
+        save_json(cache_path, diet)
+        return diet
+    st.error(f"Diet generation failed: {last_error}")
     st.stop()
 
+def generate_diet(user, fresh=False):
+    profile_json = json.dumps(user, sort_keys=True)
+    if fresh:
+        # Explicit regeneration bypasses both cache layers
+        _generate_diet_cached.clear()
+        if os.path.exists(_diet_cache_path(profile_json)):
+            os.remove(_diet_cache_path(profile_json))
+    return _generate_diet_cached(profile_json)
+
+# =================================================
+# CHARTS
+# =================================================
+@st.cache_data(show_spinner=False)
+def render_weekly(df_csv):
+    import matplotlib.pyplot as plt
+    import pandas as pd
+
+    last_7 = pd.read_csv(io.StringIO(df_csv), index_col=0, parse_dates=True)
+    fig, ax = plt.subplots(figsize=(8, 4))
+
+    ax.plot(
+        last_7.index.strftime("%a"),
+        last_7["planned"],
+        marker="o",
+        label="Planned",
+        linewidth=2
+    )
+
+    ax.plot(
+        last_7.index.strftime("%a"),
+        last_7["consumed"],
+        marker="o",
+        label="Consumed",
+        linewidth=2
+    )
+
+    ax.set_ylabel("Calories")
+    ax.set_title("Last 7 Days Calories")
+    ax.legend()
+    ax.grid(alpha=0.3)
+
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", bbox_inches="tight")
+    plt.close(fig)
+    return buf.getvalue()
+
 # =================================================
 # SESSION
 # =================================================
@@ -175,14 +501,18 @@ if not st.session_state.user:
         if st.button("Login"):
             if login(email, pwd):
                 st.session_state.user = email
-                st.session_state.diet = load_json(DIET_FILE, {}).get(email)
+                diet = load_user_data(DIETS_DIR, DIET_FILE, email, None)
+                st.session_state.diet = with_planned(diet) if diet else None
                 st.rerun()
             else:
                 st.error("Invalid credentials")
 
     with t2:
         email = st.text_input("New Email")
-        pwd = st.text_input("New Password", type="password")
+        pwd = st.text_input(
+            "New Password", type="password",
+            key="signup_pwd", on_change=prehash_password
+        )
         if st.button("Create Account"):
             if signup(email, pwd):
                 st.success("Account created. Login now.")
@@ -191,6 +521,9 @@ if not st.session_state.user:
 
     st.stop()
 
+# History is read once per rerun and shared by the sections below
+st.session_state["_hist"] = load_user_data(HISTORY_DIR, HISTORY_FILE, st.session_state.user, {})
+
 # =================================================
 # HEADER
 # =================================================
@@ -219,10 +552,8 @@ with st.sidebar:
             "diet": "Veg",
             "activity": "Medium"
         }
-        st.session_state.diet = generate_diet(user)
-        diets = load_json(DIET_FILE, {})
-        diets[st.session_state.user] = st.session_state.diet
-        save_json(DIET_FILE, diets)
+        st.session_state.diet = generate_diet(user, fresh=True)
+        save_user_data(DIETS_DIR, st.session_state.user, st.session_state.diet)
 
 # =================================================
 # TRACKER
@@ -241,28 +572,32 @@ if st.session_state.diet:
         else:
             st.info("🔒 Past Day — Read only")
 
-        planned = sum(m["calories"] for m in st.session_state.diet[day])
-        consumed = 0
-
-        for i, m in enumerate(st.session_state.diet[day]):
-            a,b,c = st.columns([4,2,2])
-            with a:
-                st.write(f"🍽️ {m['dish']} ({m['standard_quantity']})")
-            with b:
-                if is_today:
-                    qty = st.number_input(
-                        "Quanty you ate", 0.0, 5.0, 1.0, 0.5,
-                        key=f"{day}_q{i}"
-                    )
-                    eaten = st.checkbox("Eaten", key=f"{day}_e{i}")
-                else:
-                    qty = 1
-                    eaten = False
-            with c:
-                st.write(f"🔥 {m['calories']} kcal")
-
-            if is_today and eaten:
-                consumed += m["calories"] * qty
+        import pandas as pd
+
+        meals_df = pd.DataFrame(st.session_state.diet[day]["meals"])
+        if is_today:
+            # Tracking inputs only exist for today; past days are read only
+            meals_df = meals_df.assign(qty=1.0, eaten=False)
+        planned = st.session_state.diet[day]["planned"]
+
+        edited = st.data_editor(
+            meals_df,
+            column_config={
+                "dish": st.column_config.TextColumn("🍽️ Dish"),
+                "standard_quantity": st.column_config.TextColumn("Quantity"),
+                "calories": st.column_config.NumberColumn("🔥 kcal"),
+                "qty": st.column_config.NumberColumn(
+                    "Quantity you ate", min_value=0.0, max_value=5.0, step=0.5
+                ),
+                "eaten": st.column_config.CheckboxColumn("Eaten")
+            },
+            disabled=["dish", "standard_quantity", "calories"] if is_today else True,
+            hide_index=True,
+            use_container_width=True,
+            key=f"editor_{day}"
+        )
+
+        consumed = float((edited["calories"] * edited["qty"] * edited["eaten"]).sum()) if is_today else 0
 
     with col2:
         st.subheader("📊 Summary")
@@ -278,21 +613,20 @@ if st.session_state.diet:
                 st.success("🏅 Perfect Day Completed!")
 
             if st.button("💾 Save / Update Today"):
-                history = load_json(HISTORY_FILE, {})
-                history.setdefault(st.session_state.user, {})
-                history[st.session_state.user][TODAY_DATE] = {
+                # Re-read so saves from other sessions are not overwritten
+                history = load_user_data(HISTORY_DIR, HISTORY_FILE, st.session_state.user, {})
+                history[TODAY_DATE] = {
                     "day": day,
                     "planned": planned,
                     "consumed": int(consumed)
                 }
-                save_json(HISTORY_FILE, history)
+                save_user_data(HISTORY_DIR, st.session_state.user, history)
+                st.session_state["_hist"] = history
                 st.success("Saved")
 
         else:
-            hist = load_json(HISTORY_FILE, {}).get(st.session_state.user, {})
-            record = hist.get(
-                next((d for d, v in hist.items() if v["day"] == day), None)
-            )
+            date_key = history_index(st.session_state.user).get(day)
+            record = st.session_state["_hist"].get(date_key)
 
             if record:
                 st.metric("📋 Planned", record["planned"])
@@ -306,7 +640,7 @@ if st.session_state.diet:
 st.markdown("---")
 st.subheader("📜 History")
 
-hist = load_json(HISTORY_FILE, {}).get(st.session_state.user, {})
+hist = st.session_state["_hist"]
 if hist:
     rows = [{"date": d, **v} for d, v in hist.items()]
     st.dataframe(rows, use_container_width=True)
@@ -319,9 +653,11 @@ else:
 st.markdown("---")
 st.subheader("📈 Weekly Calories Overview")
 
-hist = load_json(HISTORY_FILE, {}).get(st.session_state.user, {})
+hist = st.session_state["_hist"]
 
 if hist:
+    import pandas as pd
+
     # Convert history dict → DataFrame
     df = pd.DataFrame.from_dict(hist, orient="index")
     df.index = pd.to_datetime(df.index)
@@ -331,30 +667,7 @@ if hist:
     last_7 = df.tail(7)
 
     if not last_7.empty:
-        fig, ax = plt.subplots(figsize=(8, 4))
-
-        ax.plot(
-            last_7.index.strftime("%a"),
-            last_7["planned"],
-            marker="o",
-            label="Planned",
-            linewidth=2
-        )
-
-        ax.plot(
-            last_7.index.strftime("%a"),
-            last_7["consumed"],
-            marker="o",
-            label="Consumed",
-            linewidth=2
-        )
-
-        ax.set_ylabel("Calories")
-        ax.set_title("Last 7 Days Calories")
-        ax.legend()
-        ax.grid(alpha=0.3)
-
-        st.pyplot(fig)
+        st.image(render_weekly(last_7[["planned", "consumed"]].to_csv()))
     else:
         st.info("Not enough data for weekly chart yet.")
 else: